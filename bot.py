@@ -1,13 +1,23 @@
+import asyncio
 import csv
 import io
-import json
 import logging
 import os
-from datetime import datetime, timedelta
-from typing import Dict, Optional
-
-import requests
+import re
+import time
+from bisect import bisect_right
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from itertools import chain, groupby
+from typing import Awaitable, Callable, Dict, Iterator, Optional, Tuple
+
+import aiohttp
+from aiolimiter import AsyncLimiter
+import orjson
+import uvloop
+from cachetools import TTLCache
 from telegram import ReplyKeyboardMarkup, Update
+from telegram.constants import ParseMode
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
 
 from dotenv import load_dotenv
@@ -26,25 +36,111 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 USER_DATA_FILE = "user_data.json"
+HISTORY_DIR = "history"
 user_data_storage: Dict[int, dict] = {}
+history_index: Dict[Tuple[int, str, str], dict] = {}
+http_session: Optional[aiohttp.ClientSession] = None
+
+SAVE_DELAY = 0.5
+_dirty = False
+_flush_handle: Optional[asyncio.TimerHandle] = None
+_flush_task: Optional[asyncio.Task] = None
+save_lock: Optional[asyncio.Lock] = None
+
+weather_cache: TTLCache = TTLCache(maxsize=1024, ttl=600)
+forecast_cache: TTLCache = TTLCache(maxsize=1024, ttl=3600)
+not_found_cache: TTLCache = TTLCache(maxsize=1024, ttl=60)
+
+api_limiter = AsyncLimiter(max_rate=55, time_period=60)
+weather_inflight: Dict[str, asyncio.Future] = {}
+forecast_inflight: Dict[str, asyncio.Future] = {}
+
+def city_key(city: str) -> str:
+    return city.strip().lower()
 
 def load_persistent_data():
     global user_data_storage
     if os.path.exists(USER_DATA_FILE):
         try:
-            with open(USER_DATA_FILE, "r", encoding="utf-8") as f:
-                raw = json.load(f)
+            with open(USER_DATA_FILE, "rb") as f:
+                raw = orjson.loads(f.read())
                 user_data_storage = {int(k): v for k, v in raw.items()}
         except Exception as e:
             logger.error(f"Ошибка загрузки данных: {e}")
-
-def save_persistent_data():
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    migrate_legacy_history()
+    build_history_index()
+
+def migrate_legacy_history():
+    migrated = False
+    for user_id, entry in user_data_storage.items():
+        history = entry.get("history")
+        if history is None:
+            continue
+        path = history_path(user_id)
+        if os.path.exists(path):
+            logger.warning(f"История {user_id} уже перенесена, устаревшая копия удалена")
+            del entry["history"]
+            migrated = True
+            continue
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(b"".join(orjson.dumps(record) + b"\n" for record in history))
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(f"Ошибка переноса истории {user_id}: {e}")
+            continue
+        del entry["history"]
+        migrated = True
+    if migrated:
+        write_persistent_data(dump_user_data())
+
+def dump_user_data() -> bytes:
+    return orjson.dumps(user_data_storage, option=orjson.OPT_NON_STR_KEYS)
+
+def write_persistent_data(payload: bytes):
+    tmp_path = USER_DATA_FILE + ".tmp"
     try:
-        with open(USER_DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(user_data_storage, f, ensure_ascii=False, indent=4)
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, USER_DATA_FILE)
+        dir_fd = os.open(os.path.dirname(os.path.abspath(USER_DATA_FILE)), os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
     except Exception as e:
         logger.error(f"Ошибка сохранения: {e}")
 
+async def save_persistent_data():
+    async with save_lock:
+        payload = dump_user_data()
+        await asyncio.to_thread(write_persistent_data, payload)
+
+async def flush_persistent_data():
+    global _dirty, _flush_handle
+    if _flush_handle:
+        _flush_handle.cancel()
+        _flush_handle = None
+    if not _dirty:
+        return
+    _dirty = False
+    await save_persistent_data()
+
+def _start_flush():
+    global _flush_handle, _flush_task
+    _flush_handle = None
+    _flush_task = asyncio.create_task(flush_persistent_data())
+
+def schedule_save():
+    global _dirty, _flush_handle
+    _dirty = True
+    if _flush_handle is None:
+        _flush_handle = asyncio.get_running_loop().call_later(SAVE_DELAY, _start_flush)
+
 def get_default_city(user_id: int) -> Optional[str]:
     return user_data_storage.get(user_id, {}).get("default_city")
 
@@ -52,32 +148,107 @@ def set_default_city(user_id: int, city: str):
     if user_id not in user_data_storage:
         user_data_storage[user_id] = {}
     user_data_storage[user_id]["default_city"] = city
-    save_persistent_data()
+    schedule_save()
+
+def build_history_index():
+    if not os.path.isdir(HISTORY_DIR):
+        return
+    for name in os.listdir(HISTORY_DIR):
+        stem, ext = os.path.splitext(name)
+        if ext != ".ndjson" or not stem.isdigit():
+            continue
+        user_id = int(stem)
+        for record in get_user_history(user_id):
+            index_history_record(user_id, record)
+
+def record_date(record: dict) -> str:
+    ts = record["timestamp"]
+    if isinstance(ts, str):
+        return ts[:10]
+    return time.strftime("%Y-%m-%d", time.localtime(ts))
+
+def record_datetime(record: dict) -> str:
+    ts = record["timestamp"]
+    if isinstance(ts, str):
+        return ts
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(ts))
+
+def index_history_record(user_id: int, record: dict):
+    history_index[(user_id, record["city"], record_date(record))] = record
+
+def history_path(user_id: int) -> str:
+    return os.path.join(HISTORY_DIR, f"{user_id}.ndjson")
+
+def append_history_record(user_id: int, record: dict):
+    # Leading newline terminates any torn line left by an interrupted append.
+    with open(history_path(user_id), "ab") as f:
+        f.write(b"\n" + orjson.dumps(record))
+    index_history_record(user_id, record)
 
 def add_to_history(user_id: int, city: str, temp: float, desc: str):
-    if user_id not in user_data_storage:
-        user_data_storage[user_id] = {}
-    if "history" not in user_data_storage[user_id]:
-        user_data_storage[user_id]["history"] = []
-    user_data_storage[user_id]["history"].append({
-        "city": city,
-        "temp": temp,
-        "desc": desc,
-        "timestamp": datetime.now().isoformat()
-    })
-    save_persistent_data()
-
-def get_user_history(user_id: int):
-    return user_data_storage.get(user_id, {}).get("history", [])
-
-def get_weather_now(city: str) -> Optional[dict]:
-    url = "http://api.openweathermap.org/data/2.5/weather"
+    try:
+        append_history_record(user_id, {
+            "city": city,
+            "temp": temp,
+            "desc": desc,
+            "timestamp": int(time.time())
+        })
+    except Exception as e:
+        logger.error(f"Ошибка записи истории: {e}")
+
+def get_user_history(user_id: int) -> Iterator[dict]:
+    try:
+        with open(history_path(user_id), "rb") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    yield orjson.loads(line)
+                except orjson.JSONDecodeError as e:
+                    logger.warning(f"Пропущена повреждённая запись истории {user_id}: {e}")
+    except FileNotFoundError:
+        return
+
+async def fetch_openweather(url: str, city: str) -> Optional[dict]:
     params = {"q": city, "appid": OPENWEATHER_API_KEY, "units": "metric", "lang": "ru"}
+    for attempt in range(2):
+        async with api_limiter:
+            async with http_session.get(url, params=params) as resp:
+                if resp.status == 404:
+                    not_found_cache[city_key(city)] = True
+                    return None
+                if resp.status != 429 or attempt:
+                    resp.raise_for_status()
+                    return orjson.loads(await resp.read())
+                retry_after = resp.headers.get("Retry-After", "")
+        delay = int(retry_after) if retry_after.isdigit() else 1
+        logger.warning(f"Лимит OpenWeather для {city}, повтор через {delay} с")
+        await asyncio.sleep(delay)
+
+async def single_flight(inflight: Dict[str, asyncio.Future], key: str, fetch: Callable[[], Awaitable]):
+    future = inflight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(fetch())
+        inflight[key] = future
+        future.add_done_callback(lambda _: inflight.pop(key, None))
+    return await asyncio.shield(future)
+
+async def get_weather_now(city: str) -> Optional[dict]:
+    key = city_key(city)
+    if key in not_found_cache:
+        return None
+    result = weather_cache.get(key)
+    if not result:
+        result = await single_flight(weather_inflight, key, lambda: fetch_weather_now(city))
+    return dict(result, city=city) if result else None
+
+async def fetch_weather_now(city: str) -> Optional[dict]:
+    url = "http://api.openweathermap.org/data/2.5/weather"
     try:
-        resp = requests.get(url, params=params, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
-        return {
+        data = await fetch_openweather(url, city)
+        if data is None:
+            return None
+        result = {
             "city": city,
             "temp": data["main"]["temp"],
             "feels_like": data["main"]["feels_like"],
@@ -85,40 +256,72 @@ def get_weather_now(city: str) -> Optional[dict]:
             "humidity": data["main"]["humidity"],
             "wind_speed": data.get("wind", {}).get("speed", 0)
         }
+        weather_cache[city_key(city)] = result
+        return result
     except Exception as e:
         logger.error(f"Ошибка погоды для {city}: {e}")
         return None
 
-def get_5_day_forecast(city: str) -> Optional[list]:
+async def get_5_day_forecast(city: str) -> Optional[list]:
+    key = city_key(city)
+    if key in not_found_cache:
+        return None
+    cached = forecast_cache.get(key)
+    if cached:
+        return cached
+    return await single_flight(forecast_inflight, key, lambda: fetch_5_day_forecast(city))
+
+async def fetch_5_day_forecast(city: str) -> Optional[list]:
     url = "http://api.openweathermap.org/data/2.5/forecast"
-    params = {"q": city, "appid": OPENWEATHER_API_KEY, "units": "metric", "lang": "ru"}
     try:
-        resp = requests.get(url, params=params, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
-        days = {}
-        for item in data["list"]:
-            date = datetime.fromtimestamp(item["dt"]).strftime("%Y-%m-%d")
-            if date not in days:
-                days[date] = {
-                    "date": date,
-                    "temp": item["main"]["temp"],
-                    "desc": item["weather"][0]["description"]
-                }
-            if len(days) >= 5:
+        data = await fetch_openweather(url, city)
+        if data is None:
+            return None
+        offset = data.get("city", {}).get("timezone", 0)
+
+        def local_date(item: dict) -> str:
+            return datetime.fromtimestamp(item["dt"] + offset, timezone.utc).strftime("%Y-%m-%d")
+
+        forecast = []
+        for date, group in groupby(data["list"], key=local_date):
+            items = list(group)
+            descs = Counter(item["weather"][0]["description"] for item in items)
+            forecast.append({
+                "date": date,
+                "temp": sum(item["main"]["temp"] for item in items) / len(items),
+                "desc": descs.most_common(1)[0][0]
+            })
+            if len(forecast) == 5:
                 break
-        return list(days.values())[:5]
+        forecast_cache[city_key(city)] = forecast
+        return forecast
     except Exception as e:
         logger.error(f"Ошибка прогноза для {city}: {e}")
         return None
 
 def get_yesterday_weather(user_id: int, city: str) -> Optional[dict]:
-    history = get_user_history(user_id)
     yesterday = (datetime.now().date() - timedelta(days=1)).isoformat()
-    for record in reversed(history):
-        if record["city"] == city and record["timestamp"].startswith(yesterday):
-            return record
-    return None
+    return history_index.get((user_id, city, yesterday))
+
+TEMP_THRESHOLDS = (-5, 5, 15, 25)
+TEMP_ADVICE = (
+    "Очень холодно! Теплое пальто, шапка, шарф, перчатки — обязательно.",
+    "Обязательно наденьте тёплую куртку, шапку и перчатки.",
+    "Рекомендуется куртка или пальто.",
+    "Тёплая одежда не требуется, но возьмите лёгкую куртку.",
+    "Наденьте лёгкую одежду.",
+)
+PRECIP_ADVICE = {
+    "rain": "Возьмите зонт и наденьте непромокаемую обувь.",
+    "snow": "Наденьте непромокаемую обувь и тёплую одежду.",
+}
+ADVICE = {
+    (band, precip): temp_advice + (" " + PRECIP_ADVICE[precip] if precip else "")
+    for band, temp_advice in enumerate(TEMP_ADVICE)
+    for precip in (None, *PRECIP_ADVICE)
+}
+RAIN_RE = re.compile(r"дожд|ливень")
+SNOW_RE = re.compile(r"снег")
 
 def format_now_message(data: dict) -> str:
     city = data["city"]
@@ -127,244 +330,230 @@ def format_now_message(data: dict) -> str:
     desc = data["desc"].capitalize()
     humidity = data["humidity"]
     wind = data["wind_speed"]
-    advice = []
-    t = temp
-    if t >= 25:
-        advice.append("Наденьте лёгкую одежду.")
-    elif t >= 15:
-        advice.append("Тёплая одежда не требуется, но возьмите лёгкую куртку.")
-    elif t >= 5:
-        advice.append("Рекомендуется куртка или пальто.")
-    elif t >= -5:
-        advice.append("Обязательно наденьте тёплую куртку, шапку и перчатки.")
+    desc_l = data["desc"].lower()
+    if RAIN_RE.search(desc_l):
+        precip = "rain"
+    elif SNOW_RE.search(desc_l):
+        precip = "snow"
     else:
-        advice.append("Очень холодно! Теплое пальто, шапка, шарф, перчатки — обязательно.")
-    if "дождь" in data["desc"] or "ливень" in data["desc"]:
-        advice.append("Возьмите зонт и наденьте непромокаемую обувь.")
-    elif "снег" in data["desc"]:
-        advice.append("Наденьте непромокаемую обувь и тёплую одежду.")
+        precip = None
+    advice = ADVICE[(bisect_right(TEMP_THRESHOLDS, temp), precip)]
     return (
         f"🌤 <b>{city}</b>\n"
         f"Температура: {temp:.1f}°C (ощущается как {feels:.1f}°C)\n"
         f"Описание: {desc}\n"
         f"Влажность: {humidity}%, Ветер: {wind} м/с\n\n"
-        f"💡 <i>{' '.join(advice)}</i>"
+        f"💡 <i>{advice}</i>"
     )
 
 def format_forecast_message(city: str, days: list) -> str:
     lines = [f"📅 <b>Прогноз на 5 дней — {city}</b>"]
     for d in days:
-        date = datetime.strptime(d["date"], "%Y-%m-%d").strftime("%d.%m")
+        date = f"{d['date'][8:10]}.{d['date'][5:7]}"
         lines.append(f"• {date}: {d['temp']:.1f}°C, {d['desc'].capitalize()}")
     lines.append("\n💡 Одевайтесь по погоде!")
     return "\n".join(lines)
 
 MAIN_MENU = [["🌤 Погода", "🔁 Сравнить погоду"], ["📊 Статистика", "📤 Экспорт CSV"], ["⚙️ Установить город"]]
 
-def main_menu_markup():
-    return ReplyKeyboardMarkup(MAIN_MENU, resize_keyboard=True)
+MAIN_MENU_MARKUP = ReplyKeyboardMarkup(MAIN_MENU, resize_keyboard=True)
+WEATHER_TYPE_MARKUP = ReplyKeyboardMarkup([["Сейчас", "Вчера", "На 5 дней"], ["← Назад"]], resize_keyboard=True)
+CITY_SOURCE_MARKUP = ReplyKeyboardMarkup([["Город по умолчанию", "Новый город"], ["← Назад"]], resize_keyboard=True)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
-    await update.message.reply_text("Привет! Выберите действие:", reply_markup=main_menu_markup())
+    await update.message.reply_text("Привет! Выберите действие:", reply_markup=MAIN_MENU_MARKUP)
 
 async def send_weather_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, city: str):
     context.user_data["temp_city"] = city
     context.user_data["state"] = "choose_weather_type"
-    kb = [["Сейчас", "Вчера", "На 5 дней"], ["← Назад"]]
     await update.message.reply_text(
         f"Город: {city}\nВыберите тип погоды:",
-        reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True)
+        reply_markup=WEATHER_TYPE_MARKUP
     )
 
-async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
-    user_id = update.effective_user.id
+async def reply_with_menu(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    text: Optional[str] = None,
+    parse_mode: Optional[str] = None
+):
+    context.user_data.clear()
+    msg = f"{text}\n\nВыберите действие:" if text else "Выберите действие:"
+    await update.message.reply_text(msg, reply_markup=MAIN_MENU_MARKUP, parse_mode=parse_mode)
+
+async def menu_weather(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    default = get_default_city(update.effective_user.id)
+    if default:
+        await update.message.reply_text(
+            f"Ваш город по умолчанию: {default}\nВыберите:",
+            reply_markup=CITY_SOURCE_MARKUP
+        )
+        context.user_data["state"] = "choose_city_source"
+    else:
+        await update.message.reply_text("Введите город:")
+        context.user_data["state"] = "enter_city"
 
-    if text == "🌤 Погода":
-        default = get_default_city(user_id)
-        if default:
-            kb = [["Город по умолчанию", "Новый город"], ["← Назад"]]
-            await update.message.reply_text(
-                f"Ваш город по умолчанию: {default}\nВыберите:",
-                reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True)
-            )
-            context.user_data["state"] = "choose_city_source"
-        else:
-            await update.message.reply_text("Введите город:")
-            context.user_data["state"] = "enter_city"
+async def menu_set_default_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("Введите город для установки по умолчанию:")
+    context.user_data["state"] = "set_default_city"
 
-    elif text == "⚙️ Установить город":
-        await update.message.reply_text("Введите город для установки по умолчанию:")
-        context.user_data["state"] = "set_default_city"
+async def menu_compare_cities(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("Введите два города через пробел (например: Москва Сочи):")
+    context.user_data["state"] = "compare_cities"
 
-    elif text == "🔁 Сравнить погоду":
-        await update.message.reply_text("Введите два города через пробел (например: Москва Сочи):")
-        context.user_data["state"] = "compare_cities"
+async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    handler = MENU_HANDLERS.get(text, unknown)
+    await handler(update, context)
 
-    elif text == "📊 Статистика":
-        await show_stats(update, context)
+async def state_set_default_city(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, user_id: int):
+    if await get_weather_now(text):
+        set_default_city(user_id, text)
+        await reply_with_menu(update, context, f"✅ Город по умолчанию: {text}")
+    else:
+        await reply_with_menu(update, context, "❌ Город не найден. Попробуйте снова.")
 
-    elif text == "📤 Экспорт CSV":
-        await export_csv(update, context)
+async def state_enter_city(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, user_id: int):
+    data = await get_weather_now(text)
+    if data:
+        await send_weather_menu(update, context, data["city"])
+    else:
+        await update.message.reply_text("❌ Город не найден. Попробуйте снова.")
 
+async def state_choose_city_source(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, user_id: int):
+    if text == "← Назад":
+        await reply_with_menu(update, context)
+    elif text == "Город по умолчанию":
+        default = get_default_city(user_id)
+        if default:
+            await send_weather_menu(update, context, default)
+        else:
+            await reply_with_menu(update, context, "❌ Город по умолчанию не установлен.")
+    elif text == "Новый город":
+        await update.message.reply_text("Введите город:")
+        context.user_data["state"] = "enter_city"
     else:
-        await unknown(update, context)
+        await update.message.reply_text("Выберите из меню.")
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.strip()
-    user_id = update.effective_user.id
-    state = context.user_data.get("state")
+async def state_choose_weather_type(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, user_id: int):
+    city = context.user_data.get("temp_city")
+    if not city:
+        await reply_with_menu(update, context, "❌ Ошибка: город не задан.")
+        return
 
-    if state == "set_default_city":
-        if get_weather_now(text):
-            set_default_city(user_id, text)
-            await update.message.reply_text(f"✅ Город по умолчанию: {text}")
-        else:
-            await update.message.reply_text("❌ Город не найден. Попробуйте снова.")
-        context.user_data.clear()
-        await update.message.reply_text("Выберите действие:", reply_markup=main_menu_markup())
+    if text == "← Назад":
+        await reply_with_menu(update, context)
         return
 
-    if state == "enter_city":
-        data = get_weather_now(text)
+    if text == "Сейчас":
+        data = await get_weather_now(city)
         if data:
-            await send_weather_menu(update, context, data["city"])
+            await reply_with_menu(update, context, format_now_message(data), ParseMode.HTML)
+            add_to_history(user_id, data["city"], data["temp"], data["desc"])
         else:
-            await update.message.reply_text("❌ Город не найден. Попробуйте снова.")
-        return
-
-    if state == "choose_city_source":
-        if text == "← Назад":
-            context.user_data.clear()
-            await update.message.reply_text("Выберите действие:", reply_markup=main_menu_markup())
-            return
-        elif text == "Город по умолчанию":
-            default = get_default_city(user_id)
-            if default:
-                await send_weather_menu(update, context, default)
-            else:
-                await update.message.reply_text("❌ Город по умолчанию не установлен.")
-                context.user_data.clear()
-                await update.message.reply_text("Выберите действие:", reply_markup=main_menu_markup())
-            return
-        elif text == "Новый город":
-            await update.message.reply_text("Введите город:")
-            context.user_data["state"] = "enter_city"
-            return
+            await reply_with_menu(update, context, "❌ Не удалось получить погоду.")
+
+    elif text == "Вчера":
+        record = get_yesterday_weather(user_id, city)
+        if record:
+            fake_data = {
+                "city": city,
+                "temp": record["temp"],
+                "feels_like": record["temp"],
+                "desc": record["desc"],
+                "humidity": 0,
+                "wind_speed": 0
+            }
+            msg = f"📅 <b>Вчерашняя погода — {city}</b>\n{format_now_message(fake_data)}"
+            await reply_with_menu(update, context, msg, ParseMode.HTML)
         else:
-            await update.message.reply_text("Выберите из меню.")
-            return
-
-    if state == "choose_weather_type":
-        city = context.user_data.get("temp_city")
-        if not city:
-            await update.message.reply_text("❌ Ошибка: город не задан.")
-            context.user_data.clear()
-            await update.message.reply_text("Выберите действие:", reply_markup=main_menu_markup())
-            return
-
-        if text == "← Назад":
-            context.user_data.clear()
-            await update.message.reply_text("Выберите действие:", reply_markup=main_menu_markup())
-            return
-
-        if text == "Сейчас":
-            data = get_weather_now(city)
-            if data:
-                msg = format_now_message(data)
-                await update.message.reply_html(msg)
-                add_to_history(user_id, data["city"], data["temp"], data["desc"])
-            else:
-                await update.message.reply_text("❌ Не удалось получить погоду.")
-
-        elif text == "Вчера":
-            record = get_yesterday_weather(user_id, city)
-            if record:
-                fake_data = {
-                    "city": city,
-                    "temp": record["temp"],
-                    "feels_like": record["temp"],
-                    "desc": record["desc"],
-                    "humidity": 0,
-                    "wind_speed": 0
-                }
-                msg = f"📅 <b>Вчерашняя погода — {city}</b>\n{format_now_message(fake_data)}"
-                await update.message.reply_html(msg)
-            else:
-                await update.message.reply_text(
-                    "📂 Вчерашняя погода не найдена в архиве.\n"
-                    "Запрашивайте погоду ежедневно, чтобы она сохранялась!"
-                )
-
-        elif text == "На 5 дней":
-            forecast = get_5_day_forecast(city)
-            if forecast:
-                msg = format_forecast_message(city, forecast)
-                await update.message.reply_html(msg)
-            else:
-                await update.message.reply_text("❌ Не удалось получить прогноз.")
+            await reply_with_menu(
+                update, context,
+                "📂 Вчерашняя погода не найдена в архиве.\n"
+                "Запрашивайте погоду ежедневно, чтобы она сохранялась!"
+            )
+
+    elif text == "На 5 дней":
+        forecast = await get_5_day_forecast(city)
+        if forecast:
+            await reply_with_menu(update, context, format_forecast_message(city, forecast), ParseMode.HTML)
         else:
-            await update.message.reply_text("Выберите из меню.")
-            return
+            await reply_with_menu(update, context, "❌ Не удалось получить прогноз.")
+    else:
+        await update.message.reply_text("Выберите из меню.")
 
-        context.user_data.clear()
-        await update.message.reply_text("Выберите действие:", reply_markup=main_menu_markup())
+async def state_compare_cities(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, user_id: int):
+    cities = text.split()
+    if len(cities) != 2:
+        await update.message.reply_text("Введите ровно два города через пробел.")
         return
+    c1, c2 = cities
+    d1, d2 = await asyncio.gather(get_weather_now(c1), get_weather_now(c2), return_exceptions=True)
+    if not isinstance(d1, dict) or not isinstance(d2, dict):
+        await reply_with_menu(update, context, "❌ Один из городов не найден.")
+    else:
+        diff = d1["temp"] - d2["temp"]
+        msg = (
+            f"🌡 <b>{c1}</b>: {d1['temp']:.1f}°C ({d1['desc']})\n"
+            f"🌡 <b>{c2}</b>: {d2['temp']:.1f}°C ({d2['desc']})\n"
+            f"Разница: <b>{diff:+.1f}°C</b>"
+        )
+        await reply_with_menu(update, context, msg, ParseMode.HTML)
+
+STATE_HANDLERS: Dict[str, Callable[[Update, ContextTypes.DEFAULT_TYPE, str, int], Awaitable[None]]] = {
+    "set_default_city": state_set_default_city,
+    "enter_city": state_enter_city,
+    "choose_city_source": state_choose_city_source,
+    "choose_weather_type": state_choose_weather_type,
+    "compare_cities": state_compare_cities,
+}
 
-    if state == "compare_cities":
-        cities = text.split()
-        if len(cities) != 2:
-            await update.message.reply_text("Введите ровно два города через пробел.")
-            return
-        c1, c2 = cities
-        d1, d2 = get_weather_now(c1), get_weather_now(c2)
-        if not d1 or not d2:
-            await update.message.reply_text("❌ Один из городов не найден.")
-        else:
-            diff = d1["temp"] - d2["temp"]
-            msg = (
-                f"🌡 <b>{c1}</b>: {d1['temp']:.1f}°C ({d1['desc']})\n"
-                f"🌡 <b>{c2}</b>: {d2['temp']:.1f}°C ({d2['desc']})\n"
-                f"Разница: <b>{diff:+.1f}°C</b>"
-            )
-            await update.message.reply_html(msg)
-        context.user_data.clear()
-        await update.message.reply_text("Выберите действие:", reply_markup=main_menu_markup())
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()
+    user_id = update.effective_user.id
+    handler = STATE_HANDLERS.get(context.user_data.get("state"))
+    if handler:
+        await handler(update, context, text, user_id)
         return
-
     await handle_main_menu(update, context, text)
 
 async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    history = get_user_history(user_id)
-    if not history:
+    cities = Counter()
+    first = last = None
+    for h in get_user_history(user_id):
+        cities[h["city"]] += 1
+        if first is None:
+            first = h
+        last = h
+    if first is None:
         await update.message.reply_text("📊 История пуста.")
         return
-    from collections import Counter
-    cities = [h["city"] for h in history]
-    most_common, count = Counter(cities).most_common(1)[0]
+    most_common, count = cities.most_common(1)[0]
     msg = (
         f"📊 Статистика:\n"
-        f"Всего запросов: {len(history)}\n"
+        f"Всего запросов: {sum(cities.values())}\n"
         f"Самый частый город: {most_common} ({count} раз)\n"
-        f"Первый: {history[0]['timestamp'][:10]}\n"
-        f"Последний: {history[-1]['timestamp'][:10]}"
+        f"Первый: {record_date(first)}\n"
+        f"Последний: {record_date(last)}"
     )
     await update.message.reply_text(msg)
 
 async def export_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     history = get_user_history(user_id)
-    if not history:
+    first = next(history, None)
+    if first is None:
         await update.message.reply_text("📭 Нет данных для экспорта.")
         return
-    output = io.StringIO()
+    csv_buffer = io.BytesIO()
+    output = io.TextIOWrapper(csv_buffer, encoding="utf-8-sig", newline="")
     writer = csv.writer(output)
     writer.writerow(["Город", "Температура (°C)", "Погода", "Дата и время"])
-    for h in history:
-        writer.writerow([h["city"], h["temp"], h["desc"], h["timestamp"]])
-    csv_bytes = output.getvalue().encode("utf-8-sig")
-    csv_buffer = io.BytesIO(csv_bytes)
+    for h in chain((first,), history):
+        writer.writerow([h["city"], h["temp"], h["desc"], record_datetime(h)])
+    output.detach()
+    csv_buffer.seek(0)
     csv_buffer.name = "weather_history.csv"
     await update.message.reply_document(
         document=csv_buffer,
@@ -375,6 +564,14 @@ async def export_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❓ Используйте меню или /start.")
 
+MENU_HANDLERS: Dict[str, Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[None]]] = {
+    "🌤 Погода": menu_weather,
+    "⚙️ Установить город": menu_set_default_city,
+    "🔁 Сравнить погоду": menu_compare_cities,
+    "📊 Статистика": show_stats,
+    "📤 Экспорт CSV": export_csv,
+}
+
 async def unified_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     if text.startswith("/"):
@@ -385,9 +582,31 @@ async def unified_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     await handle_message(update, context)
 
+async def on_startup(app: Application):
+    global http_session, save_lock
+    save_lock = asyncio.Lock()
+    http_session = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=10),
+        connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300)
+    )
+
+async def on_shutdown(app: Application):
+    if _flush_task:
+        await _flush_task
+    await flush_persistent_data()
+    if http_session:
+        await http_session.close()
+
 def main():
+    asyncio.set_event_loop(uvloop.new_event_loop())
     load_persistent_data()
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, unified_handler))
     logger.info("✅ Бот запущен.")